@@ -830,18 +830,42 @@
 from flask import Flask, request, jsonify, render_template
 from flask_cors import CORS
 import torch
+import torch.nn.functional as F
+import transformers
 from transformers import AutoTokenizer, AutoModel
-from sklearn.metrics.pairwise import cosine_similarity
 import numpy as np
-import json
+import ahocorasick
+import orjson
 import os
 import sqlite3
-from datetime import datetime
-from contextlib import closing
+import hashlib
+import shutil
+import tempfile
+from contextlib import closing, contextmanager
 import logging
 from logging.handlers import RotatingFileHandler
 import socket
 import sys
+import threading
+import multiprocessing
+import queue
+import time
+import inspect
+import functools
+import re
+from concurrent.futures import Future, ThreadPoolExecutor
+from functools import reduce
+from collections import Counter
+from operator import or_
+
+# ONNX Runtime is optional; without it the TorchScript path is used
+try:
+    import onnx
+    import onnxruntime as ort
+    from onnxruntime.transformers import optimizer as ort_optimizer
+    from onnxruntime.quantization import quantize_dynamic as ort_quantize_dynamic, QuantType
+except ImportError:
+    ort = None
 
 app = Flask(__name__)
 # Configure CORS to allow frontend service
@@ -861,6 +885,56 @@ CORS(app, resources={
 # Database configuration
 DATABASE = os.getenv('DATABASE_PATH', 'patients.db')
 
+# How long the embedding batcher waits to coalesce concurrent requests
+EMBED_BATCH_WINDOW_MS = float(os.getenv('EMBED_BATCH_WINDOW_MS', '10'))
+EMBED_MAX_BATCH_SIZE = int(os.getenv('EMBED_MAX_BATCH_SIZE', '32'))
+# Texts whose token counts differ by less than this share a padded sub-batch
+EMBED_BUCKET_WIDTH = int(os.getenv('EMBED_BUCKET_WIDTH', '32'))
+# Symptom embeddings kept per model for repeated inputs
+EMBEDDING_CACHE_SIZE = int(os.getenv('EMBEDDING_CACHE_SIZE', '2048'))
+
+# Use every core for intra-op parallelism in the BERT forward passes
+TORCH_NUM_THREADS = int(os.getenv('TORCH_NUM_THREADS', os.cpu_count() or 1))
+torch.set_num_threads(TORCH_NUM_THREADS)
+# Requests arrive concurrently (gunicorn threads, the embedding batcher), so a
+# second inter-op pool would only compete with the intra-op threads
+try:
+    torch.set_num_interop_threads(1)
+except RuntimeError:
+    # Already fixed once inter-op work has run (e.g. on a re-import)
+    pass
+# This process only runs inference. Grad mode is thread-local, so the forward
+# passes still enter inference_mode() for the request threads.
+torch.set_grad_enabled(False)
+# Use the simple JIT executor for the traced models: the profiling executor
+# re-optimizes the graph over the first few calls, causing a second-call stall
+torch._C._jit_set_profiling_executor(False)
+torch._C._jit_set_profiling_mode(False)
+
+def _cpu_supports_bf16():
+    """True when the CPU has native BF16 dot products (AVX512-BF16 / AMX)"""
+    check = getattr(torch.cpu, '_is_avx512_bf16_supported', None)
+    return bool(check and check())
+
+# BF16 autocast for the torch inference path: 'auto' enables it only where the
+# CPU runs BF16 natively, since emulated BF16 is slower than FP32
+BF16_INFERENCE = os.getenv('BF16_INFERENCE', 'auto').lower()
+USE_BF16 = hasattr(torch.cpu, 'amp') and (
+    BF16_INFERENCE == 'true' or (BF16_INFERENCE == 'auto' and _cpu_supports_bf16())
+)
+
+def inference_autocast():
+    """Autocast context for torch forward passes; a no-op unless USE_BF16"""
+    return torch.autocast(device_type='cpu', dtype=torch.bfloat16, enabled=USE_BF16)
+
+# ONNX Runtime export settings
+USE_ONNX_RUNTIME = os.getenv('USE_ONNX_RUNTIME', 'true').lower() == 'true'
+ONNX_MODEL_DIR = os.getenv('ONNX_MODEL_DIR', 'onnx_models')
+
+# Fields shared by every JSON log line; the hostname is looked up once
+HOSTNAME = socket.gethostname()
+_STATIC = {'hostname': HOSTNAME, 'service': 'disease-detector'}
+
 # Configure logging for ELK Stack integration
 def setup_logging():
     """Configure application logging to feed into ELK Stack"""
@@ -885,16 +959,21 @@ def setup_logging():
     # JSON formatter for Logstash
     class JSONFormatter(logging.Formatter):
         def format(self, record):
+            # UTC ISO-8601 from the record's own creation time, without
+            # building a datetime object per line
+            timestamp = '%s.%06d' % (
+                time.strftime('%Y-%m-%dT%H:%M:%S', time.gmtime(record.created)),
+                int(record.created % 1 * 1000000)
+            )
             log_data = {
-                'timestamp': datetime.utcnow().isoformat(),
+                **_STATIC,
+                'timestamp': timestamp,
                 'level': record.levelname,
                 'logger': record.name,
                 'message': record.getMessage(),
                 'module': record.module,
                 'function': record.funcName,
-                'line': record.lineno,
-                'hostname': socket.gethostname(),
-                'service': 'disease-detector'
+                'line': record.lineno
             }
 
             # Add exception info if present
@@ -909,7 +988,7 @@ def setup_logging():
             if hasattr(record, 'symptoms'):
                 log_data['symptoms'] = record.symptoms
 
-            return json.dumps(log_data)
+            return orjson.dumps(log_data).decode()
 
     file_handler.setFormatter(JSONFormatter())
     logger.addHandler(file_handler)
@@ -925,33 +1004,52 @@ def setup_logging():
 
     return logger
 
+def use_worker_log_file():
+    """Move this process's JSON log output to a rotating file of its own.
+
+    RotatingFileHandler assumes a single writer. Workers forked from the
+    gunicorn master would otherwise share its handler, and each would roll
+    the file over underneath the others. Every worker writes
+    disease-detector.<pid>.log instead, which the *.log globs of the
+    Logstash and Filebeat inputs already pick up.
+    """
+    root_logger = logging.getLogger()
+    for handler in list(root_logger.handlers):
+        if not isinstance(handler, RotatingFileHandler):
+            continue
+        base, ext = os.path.splitext(handler.baseFilename)
+        worker_handler = RotatingFileHandler(
+            f"{base}.{os.getpid()}{ext}",
+            maxBytes=handler.maxBytes,
+            backupCount=handler.backupCount
+        )
+        worker_handler.setLevel(handler.level)
+        worker_handler.setFormatter(handler.formatter)
+        root_logger.removeHandler(handler)
+        handler.close()
+        root_logger.addHandler(worker_handler)
+
 # Initialize logging
 logger = setup_logging()
 
 # Initialize multiple models for ensemble prediction
 # Using multiple medical models for better accuracy
 # Note: Some models may fail to load, but we'll use what's available
+# Ensemble members are different poolings of one shared backbone forward pass,
+# so a request costs a single BERT forward instead of one per model
+EMBEDDING_VIEWS = [
+    {'name': 'mean', 'weight': 0.40},  # Average over real tokens
+    {'name': 'cls', 'weight': 0.35},   # [CLS] token state
+    {'name': 'max', 'weight': 0.25}    # Per-dimension max over real tokens
+]
+VIEW_WEIGHTS = torch.tensor([view['weight'] for view in EMBEDDING_VIEWS], dtype=torch.float32)
+VIEW_WEIGHTS /= VIEW_WEIGHTS.sum()
+
 MODELS_CONFIG = [
     {
         'name': 'Bio_ClinicalBERT',
         'model_name': 'emilyalsentzer/Bio_ClinicalBERT',
-#         'weight': 0.40,  # Higher weight for clinical model
-        'weight':0.40,
-        'tokenizer': None,
-        'model': None
-    }
-    },
-    {
-        'name': 'PubMedBERT',
-        'model_name': 'microsoft/BiomedNLP-PubMedBERT-base-uncased-abstract-fulltext',
-        'weight': 0.35,
-        'tokenizer': None,
-        'model': None
-    },
-    {
-        'name': 'BioBERT',
-        'model_name': 'dmis-lab/biobert-v1.1',
-        'weight': 0.25,
+        'weight': 1.0,
         'tokenizer': None,
         'model': None
     }
@@ -968,6 +1066,17 @@ FALLBACK_MODELS = [
     }
 ]
 
+# Scores the second and later backbones of an ensemble while the request thread
+# scores the first. Each pool thread blocks in a batcher until its batch runs,
+# so the pool holds a full batch of threads per extra model; a smaller pool
+# would queue requests here and starve the batchers of concurrent texts.
+# Threads are only started on demand. Torch and ONNX Runtime release the GIL
+# in their kernels.
+_ensemble_pool = ThreadPoolExecutor(
+    max_workers=EMBED_MAX_BATCH_SIZE * max(1, len(MODELS_CONFIG) - 1),
+    thread_name_prefix='ensemble'
+)
+
 # Common diseases and their typical symptoms (for fallback/demo)
 DISEASE_SYMPTOMS = {
     "Common Cold": ["runny nose", "sneezing", "cough", "sore throat", "congestion"],
@@ -982,15 +1091,191 @@ DISEASE_SYMPTOMS = {
     "Allergic Rhinitis": ["sneezing", "runny nose", "itchy eyes", "nasal congestion"]
 }
 
-def get_db():
-    """Get database connection"""
-    conn = sqlite3.connect(DATABASE)
+# Fixed disease order; score vectors are indexed by position in this list
+DISEASE_LIST = list(DISEASE_SYMPTOMS)
+DISEASE_INDEX = {disease: i for i, disease in enumerate(DISEASE_LIST)}
+# Prometheus label value for each disease
+DISEASE_LABEL = {disease: disease.lower().replace(' ', '_') for disease in DISEASE_SYMPTOMS}
+
+# Common symptom keywords
+SYMPTOM_KEYWORDS = [
+    'fever', 'cough', 'headache', 'pain', 'ache', 'sore', 'throat',
+    'nausea', 'vomiting', 'diarrhea', 'fatigue', 'tired', 'weak',
+    'congestion', 'runny nose', 'sneezing', 'itchy', 'burning',
+    'shortness of breath', 'chest pain', 'abdominal pain', 'stomach',
+    'chills', 'sweating', 'dizziness', 'light sensitive', 'sound sensitive',
+    'swollen', 'red', 'inflamed', 'mucus', 'phlegm', 'urination',
+    'frequent', 'cloudy', 'pelvic', 'facial', 'nasal', 'post-nasal'
+]
+
+DISEASE_SYMPTOM_SETS = {
+    disease: frozenset(symptom.lower() for symptom in symptoms)
+    for disease, symptoms in DISEASE_SYMPTOMS.items()
+}
+
+def build_symptom_automaton():
+    """Build one Aho-Corasick automaton over all keywords and disease symptom phrases"""
+    automaton = ahocorasick.Automaton()
+    phrases = set(SYMPTOM_KEYWORDS).union(*DISEASE_SYMPTOM_SETS.values())
+    for phrase in phrases:
+        automaton.add_word(phrase, phrase)
+    automaton.make_automaton()
+    return automaton
+
+SYMPTOM_AUTOMATON = build_symptom_automaton()
+
+# Each distinct disease symptom phrase owns one bit, so a disease's symptom list
+# is an int mask and overlap counting is a single AND + popcount
+SYMPTOM_PHRASE_MASKS = {
+    phrase: 1 << bit
+    for bit, phrase in enumerate(sorted(set().union(*DISEASE_SYMPTOM_SETS.values())))
+}
+DISEASE_MASKS = {
+    disease: reduce(or_, (SYMPTOM_PHRASE_MASKS[symptom] for symptom in symptoms), 0)
+    for disease, symptoms in DISEASE_SYMPTOM_SETS.items()
+}
+DISEASE_LENS = {disease: len(symptoms) for disease, symptoms in DISEASE_SYMPTOMS.items()}
+DISEASE_MASK_LIST = [DISEASE_MASKS[disease] for disease in DISEASE_LIST]
+DISEASE_LEN_ARRAY = np.array([DISEASE_LENS[disease] for disease in DISEASE_LIST], dtype=np.float32)
+# Mask of the disease symptom phrases each keyword occurs in
+KEYWORD_MASKS = {
+    keyword: reduce(or_, (mask for phrase, mask in SYMPTOM_PHRASE_MASKS.items() if keyword in phrase), 0)
+    for keyword in SYMPTOM_KEYWORDS
+}
+
+# Ring buffer sizes for the most recent /predict response times (seconds) and
+# top prediction confidences; averages are only computed when metrics are read
+RESPONSE_TIME_WINDOW = 1000
+CONFIDENCE_WINDOW = 4096
+
+def ring_mean(ring, head):
+    """Mean of the values currently held in a ring buffer"""
+    count = min(head, len(ring))
+    return float(ring[:count].mean()) if count else 0
+
+class PredictionStats:
+    """/predict counters and recent-value ring buffers, shared across processes.
+
+    Everything lives in shared memory allocated in __init__. Under gunicorn
+    with preload_app that happens in the master, so all forked workers update
+    one set of numbers and whichever worker answers /metrics reports the
+    totals. Each ring's head counts every write, so its slot is head % len(ring).
+    """
+
+    # Positions in the shared counter array
+    TOTAL, SUCCESSFUL, FAILED, RT_HEAD, CONF_HEAD = range(5)
+
+    def __init__(self, response_time_window=RESPONSE_TIME_WINDOW, confidence_window=CONFIDENCE_WINDOW):
+        self._lock = multiprocessing.Lock()
+        self._counters = np.frombuffer(multiprocessing.RawArray('q', 5), dtype=np.int64)
+        self._disease_counts = np.frombuffer(multiprocessing.RawArray('q', len(DISEASE_LIST)), dtype=np.int64)
+        self.response_times = np.frombuffer(multiprocessing.RawArray('f', response_time_window), dtype=np.float32)
+        self.confidences = np.frombuffer(multiprocessing.RawArray('f', confidence_window), dtype=np.float32)
+        self.start_time = time.time()
+
+    def record_success(self, disease, confidence):
+        """Count a successful prediction and its top disease and confidence"""
+        counters = self._counters
+        with self._lock:
+            counters[self.TOTAL] += 1
+            counters[self.SUCCESSFUL] += 1
+            if disease in DISEASE_INDEX:
+                self._disease_counts[DISEASE_INDEX[disease]] += 1
+            self.confidences[counters[self.CONF_HEAD] % len(self.confidences)] = confidence
+            counters[self.CONF_HEAD] += 1
+
+    def record_failure(self):
+        """Count a prediction that raised"""
+        with self._lock:
+            self._counters[self.TOTAL] += 1
+            self._counters[self.FAILED] += 1
+
+    def record_response_time(self, seconds):
+        """Add a /predict response time to its ring buffer"""
+        counters = self._counters
+        with self._lock:
+            self.response_times[counters[self.RT_HEAD] % len(self.response_times)] = seconds
+            counters[self.RT_HEAD] += 1
+
+    def snapshot(self):
+        """Consistent copy of the counters, per-disease counts and ring averages"""
+        with self._lock:
+            counters = self._counters.copy()
+            disease_counts = self._disease_counts.copy()
+            avg_response_time = ring_mean(self.response_times, int(counters[self.RT_HEAD]))
+            avg_confidence = ring_mean(self.confidences, int(counters[self.CONF_HEAD]))
+        return {
+            'total_predictions': int(counters[self.TOTAL]),
+            'successful_predictions': int(counters[self.SUCCESSFUL]),
+            'failed_predictions': int(counters[self.FAILED]),
+            'disease_counts': Counter({
+                DISEASE_LIST[i]: int(count) for i, count in enumerate(disease_counts) if count
+            }),
+            'avg_response_time': avg_response_time,
+            'avg_confidence': avg_confidence,
+            'start_time': self.start_time
+        }
+
+app.prediction_stats = PredictionStats()
+
+# Idle connections, pooled per process (so forked workers never reuse a
+# parent's handle) and per database file. A pool rather than a thread-local
+# cache, so servers that start a thread per request still reuse connections
+# instead of opening a new one and re-running the pragmas every time.
+_db_pools = {}
+_db_pools_lock = threading.Lock()
+
+def connect_db(database=None):
+    """Open a new database connection with per-connection tuning pragmas"""
+    conn = sqlite3.connect(database or DATABASE, check_same_thread=False)
     conn.row_factory = sqlite3.Row
+    # WAL makes fsync on checkpoint only, so NORMAL is still crash-safe
+    conn.execute('PRAGMA synchronous=NORMAL')
+    conn.execute('PRAGMA temp_store=MEMORY')
+    conn.execute('PRAGMA mmap_size=268435456')
     return conn
 
+@contextmanager
+def get_db(database=None):
+    """Borrow a pooled database connection for the duration of a with block.
+
+    Use it as `with get_db() as conn:` -- the block commits on success and
+    rolls back on error, then returns the open connection to the pool.
+    """
+    database = database or DATABASE
+    key = (os.getpid(), database)
+    with _db_pools_lock:
+        pool = _db_pools.setdefault(key, queue.SimpleQueue())
+    try:
+        conn = pool.get_nowait()
+    except queue.Empty:
+        conn = connect_db(database)
+    try:
+        with conn:
+            yield conn
+    finally:
+        pool.put(conn)
+
+def save_history(patient_id, symptoms, predicted_disease, confidence):
+    """Insert a medical_history row for a /predict call.
+
+    Written synchronously so the row is committed before the response is sent:
+    a later history read or DELETE, on any worker process, always sees it.
+    """
+    try:
+        with get_db() as conn:
+            conn.execute('''
+                INSERT INTO medical_history (patient_id, symptoms, predicted_disease, confidence)
+                VALUES (?, ?, ?, ?)
+            ''', (patient_id, symptoms, predicted_disease, confidence))
+    except Exception as e:
+        logger.error(f"Error saving to database: {e}")
+
 def init_db():
     """Initialize database with tables"""
-    with closing(get_db()) as conn:
+    with closing(connect_db()) as conn:
+        # journal_mode is persistent, so setting it once here covers every connection
+        conn.execute('PRAGMA journal_mode=WAL')
         cursor = conn.cursor()
         # Patients table
         cursor.execute('''
@@ -1013,25 +1298,211 @@ def init_db():
                 FOREIGN KEY (patient_id) REFERENCES patients(patient_id)
             )
         ''')
+        # Serves get_patient_history's "latest 10 for a patient" with an index seek
+        cursor.execute('''
+            CREATE INDEX IF NOT EXISTS idx_mh_pid_time
+            ON medical_history(patient_id, created_at DESC)
+        ''')
+        # Duplicates the implicit UNIQUE index, named so query plans are easy to read
+        cursor.execute('''
+            CREATE UNIQUE INDEX IF NOT EXISTS idx_patients_pid
+            ON patients(patient_id)
+        ''')
         conn.commit()
     print("Database initialized successfully!")
 
+def compute_disease_embeddings(tokenizer, model):
+    """Embed every disease description in one batched forward pass.
+
+    The disease texts never change, so this runs once per model at load time.
+    The result is a (num_views, num_diseases, hidden_dim) float32 tensor of
+    unit vectors, so scoring a request is a plain matrix-vector product per view.
+    Diseases are in DISEASE_LIST order.
+    """
+    disease_texts = [f"{d}: {', '.join(DISEASE_SYMPTOMS[d])}" for d in DISEASE_LIST]
+    embeddings = get_embeddings(disease_texts, tokenizer, model).transpose(0, 1)
+    return F.normalize(embeddings, dim=-1).contiguous()
+
+def trace_model(model):
+    """Compile an eager model with TorchScript, falling back to eager on failure"""
+    dummy_ids = torch.zeros((1, 32), dtype=torch.long)
+    dummy_mask = torch.ones((1, 32), dtype=torch.long)
+    try:
+        with torch.no_grad():
+            scripted = torch.jit.trace(model, (dummy_ids, dummy_mask), strict=False)
+            scripted = torch.jit.optimize_for_inference(scripted)
+        # The first calls run the JIT optimization passes; pay for them now
+        with torch.inference_mode(), inference_autocast():
+            for _ in range(2):
+                scripted(dummy_ids, dummy_mask)
+        return scripted
+    except Exception as e:
+        print(f"  TorchScript tracing failed, using eager model: {e}")
+        return model
+
+class EncoderForExport(torch.nn.Module):
+    """Expose only the last hidden state so the ONNX graph has a single output"""
+
+    def __init__(self, model):
+        super().__init__()
+        self.model = model
+
+    def forward(self, input_ids, attention_mask):
+        return self.model(input_ids=input_ids, attention_mask=attention_mask)['last_hidden_state']
+
+# Export settings that change the cached graph; part of its cache key
+ONNX_OPSET = 17
+ONNX_WEIGHT_TYPE = 'QInt8'
+
+def onnx_cache_key(model_config, model):
+    """Short hash of everything the exported graph depends on.
+
+    Covers the model id and revision, its full config, the export, fusion and
+    quantization settings, and the library versions, so a cached graph is only
+    reused for exactly the model and toolchain that produced it.
+    """
+    parts = {
+        'model_name': model_config['model_name'],
+        'revision': getattr(model.config, '_commit_hash', None),
+        'config': model.config.to_json_string(use_diff=False),
+        'opset': ONNX_OPSET,
+        'fusion': 'bert',
+        'weight_type': ONNX_WEIGHT_TYPE,
+        'torch': torch.__version__,
+        'transformers': transformers.__version__,
+        'onnx': onnx.__version__,
+        'onnxruntime': ort.__version__,
+    }
+    digest = hashlib.sha256(orjson.dumps(parts, option=orjson.OPT_SORT_KEYS)).hexdigest()
+    return digest[:16]
+
+def export_quantized_onnx(model, quantized_path):
+    """Export, fuse and INT8-quantize an eager model into quantized_path.
+
+    Every step writes into a scratch directory next to the target and the
+    result is moved into place with os.replace(), so an interrupted export
+    never leaves a truncated graph at quantized_path.
+    """
+    work_dir = tempfile.mkdtemp(dir=os.path.dirname(quantized_path), prefix='.export-')
+    try:
+        onnx_path = os.path.join(work_dir, 'model.onnx')
+        optimized_path = os.path.join(work_dir, 'model.opt.onnx')
+        staged_path = os.path.join(work_dir, 'model.int8.onnx')
+
+        dummy_ids = torch.zeros((1, 32), dtype=torch.long)
+        dummy_mask = torch.ones((1, 32), dtype=torch.long)
+        export_kwargs = {}
+        # torch >= 2.5 defaults to the dynamo exporter; keep the TorchScript one
+        if 'dynamo' in inspect.signature(torch.onnx.export).parameters:
+            export_kwargs['dynamo'] = False
+        torch.onnx.export(
+            EncoderForExport(model),
+            (dummy_ids, dummy_mask),
+            onnx_path,
+            opset_version=ONNX_OPSET,
+            input_names=['input_ids', 'attention_mask'],
+            output_names=['last_hidden_state'],
+            dynamic_axes={
+                'input_ids': {0: 'batch', 1: 'sequence'},
+                'attention_mask': {0: 'batch', 1: 'sequence'},
+                'last_hidden_state': {0: 'batch', 1: 'sequence'}
+            },
+            **export_kwargs
+        )
+
+        optimized = ort_optimizer.optimize_model(
+            onnx_path,
+            model_type='bert',
+            num_heads=model.config.num_attention_heads,
+            hidden_size=model.config.hidden_size
+        )
+        optimized.save_model_to_file(optimized_path)
+
+        ort_quantize_dynamic(
+            optimized_path,
+            staged_path,
+            weight_type=getattr(QuantType, ONNX_WEIGHT_TYPE),
+            extra_options={'DefaultTensorType': onnx.TensorProto.FLOAT}
+        )
+        os.replace(staged_path, quantized_path)
+    finally:
+        # Only the quantized graph is kept; drop the full-precision copies
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+def build_onnx_session(model_config, model):
+    """Export an eager model to ONNX, apply BERT graph fusions and INT8 quantization.
+
+    The quantized graph is cached in ONNX_MODEL_DIR under a name that includes
+    onnx_cache_key(), and reused on later starts with the same model and
+    libraries. Returns None when ONNX Runtime is unavailable or any step
+    fails, so the caller falls back to the torch path.
+    """
+    if ort is None or not USE_ONNX_RUNTIME:
+        return None
+
+    try:
+        os.makedirs(ONNX_MODEL_DIR, exist_ok=True)
+        quantized_path = os.path.join(
+            ONNX_MODEL_DIR,
+            f"{model_config['name']}.{onnx_cache_key(model_config, model)}.int8.onnx"
+        )
+        if not os.path.exists(quantized_path):
+            export_quantized_onnx(model, quantized_path)
+
+        session_options = ort.SessionOptions()
+        session_options.intra_op_num_threads = TORCH_NUM_THREADS
+        session_options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        try:
+            return ort.InferenceSession(
+                quantized_path,
+                sess_options=session_options,
+                providers=['CPUExecutionProvider']
+            )
+        except Exception:
+            # An unreadable graph would fail the same way on every start; drop it
+            # so the next start exports a fresh one
+            os.remove(quantized_path)
+            raise
+    except Exception as e:
+        print(f"  ONNX Runtime export failed, using TorchScript model: {e}")
+        return None
+
+def load_model(model_config):
+    """Load, compile and warm up a single model described by model_config"""
+    tokenizer = AutoTokenizer.from_pretrained(model_config['model_name'])
+    model = AutoModel.from_pretrained(model_config['model_name'])
+    model.eval()
+
+    session = build_onnx_session(model_config, model)
+    if session is not None:
+        model = session
+    else:
+        if not USE_BF16:
+            # INT8 weights for the Linear layers, which dominate BERT inference on CPU.
+            # Skipped under BF16: dynamically quantized Linear layers reject BF16 inputs.
+            model = torch.ao.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+        model = trace_model(model)
+
+    disease_mat = compute_disease_embeddings(tokenizer, model)
+
+    model_config['tokenizer'] = tokenizer
+    model_config['model'] = model
+    model_config['disease_mat'] = disease_mat
+    model_config['batcher'] = EmbeddingBatcher(model_config)
+
 def load_models():
     """Load multiple models for ensemble prediction"""
     global MODELS_CONFIG, FALLBACK_MODELS
     loaded_models = []
+    # Cached embeddings belong to whatever models were loaded before
+    _embed_cached.cache_clear()
 
     print("Loading ensemble of medical models for improved accuracy...")
 
     for model_config in MODELS_CONFIG:
         try:
             print(f"Loading {model_config['name']}...")
-            tokenizer = AutoTokenizer.from_pretrained(model_config['model_name'])
-            model = AutoModel.from_pretrained(model_config['model_name'])
-            model.eval()
-
-            model_config['tokenizer'] = tokenizer
-            model_config['model'] = model
+            load_model(model_config)
             loaded_models.append(model_config['name'])
             print(f"✓ {model_config['name']} loaded successfully!")
 
@@ -1047,12 +1518,7 @@ def load_models():
         for model_config in FALLBACK_MODELS:
             try:
                 print(f"Loading fallback {model_config['name']}...")
-                tokenizer = AutoTokenizer.from_pretrained(model_config['model_name'])
-                model = AutoModel.from_pretrained(model_config['model_name'])
-                model.eval()
-
-                model_config['tokenizer'] = tokenizer
-                model_config['model'] = model
+                load_model(model_config)
                 loaded_models.append(model_config['name'])
                 print(f"✓ Fallback model loaded!")
                 break
@@ -1079,65 +1545,173 @@ def get_loaded_models():
                 loaded.append(model_config)
     return loaded
 
-def predict_disease_simple(symptoms_text):
-    """Simple symptom matching approach"""
-    symptoms_lower = symptoms_text.lower()
-    scores = {}
+def match_symptom_phrases(symptoms_text):
+    """Return every known symptom phrase or keyword occurring in the text.
 
-    for disease, typical_symptoms in DISEASE_SYMPTOMS.items():
-        score = 0
-        for symptom in typical_symptoms:
-            if symptom.lower() in symptoms_lower:
-                score += 1
-        if score > 0:
-            scores[disease] = score / len(typical_symptoms)
+    Matches are substrings, exactly like the previous `phrase in text` checks,
+    but found in a single pass of SYMPTOM_AUTOMATON over the input.
+    """
+    return {phrase for _, phrase in SYMPTOM_AUTOMATON.iter(symptoms_text.lower())}
 
-    # Sort by score
-    sorted_diseases = sorted(scores.items(), key=lambda x: x[1], reverse=True)
-    return sorted_diseases[:3]  # Return top 3
+def score_symptom_mask(symptom_mask):
+    """Fraction of each disease's symptoms set in symptom_mask; diseases with no overlap are omitted"""
+    return {
+        disease: (symptom_mask & mask).bit_count() / DISEASE_LENS[disease]
+        for disease, mask in DISEASE_MASKS.items()
+        if symptom_mask & mask
+    }
 
-def get_embedding(text, tokenizer, model):
-    """Get embedding vector for text using a specific model"""
-    inputs = tokenizer(
-        text,
-        return_tensors="pt",
-        truncation=True,
-        max_length=512,
-        padding=True
-    )
+def symptom_mask_vector(symptom_mask):
+    """score_symptom_mask as a float32 vector aligned with DISEASE_LIST (0 for no overlap)"""
+    counts = np.array([(symptom_mask & mask).bit_count() for mask in DISEASE_MASK_LIST], dtype=np.float32)
+    return counts / DISEASE_LEN_ARRAY
 
-    with torch.no_grad():
-        outputs = model(**inputs)
-        # Use mean pooling of last hidden state
-        embeddings = outputs.last_hidden_state.mean(dim=1).squeeze()
+def patient_symptom_mask(matches):
+    """Bitmask of the disease symptom phrases among the matched phrases"""
+    return reduce(or_, (SYMPTOM_PHRASE_MASKS.get(phrase, 0) for phrase in matches), 0)
 
-    return embeddings.numpy()
+def predict_disease_simple(symptoms_text):
+    """Simple symptom matching approach"""
+    matches = match_symptom_phrases(symptoms_text)
+    scores = score_symptom_mask(patient_symptom_mask(matches))
 
-def extract_symptoms_keywords(symptoms_text):
-    """Extract key symptom keywords for better matching"""
-    symptoms_lower = symptoms_text.lower()
-    keywords = []
+    # Sort by score
+    sorted_diseases = sorted(scores.items(), key=lambda x: x[1], reverse=True)
+    return sorted_diseases[:3]  # Return top 3
 
-    # Common symptom keywords
-    symptom_keywords = [
-        'fever', 'cough', 'headache', 'pain', 'ache', 'sore', 'throat',
-        'nausea', 'vomiting', 'diarrhea', 'fatigue', 'tired', 'weak',
-        'congestion', 'runny nose', 'sneezing', 'itchy', 'burning',
-        'shortness of breath', 'chest pain', 'abdominal pain', 'stomach',
-        'chills', 'sweating', 'dizziness', 'light sensitive', 'sound sensitive',
-        'swollen', 'red', 'inflamed', 'mucus', 'phlegm', 'urination',
-        'frequent', 'cloudy', 'pelvic', 'facial', 'nasal', 'post-nasal'
-    ]
+def pool_hidden_states(last_hidden, attention_mask):
+    """Pool token states into one vector per EMBEDDING_VIEWS entry, shape (batch, views, hidden)"""
+    # Pool over real tokens only, so padding doesn't dilute the embedding
+    mask = attention_mask.unsqueeze(-1).to(last_hidden.dtype)
+    pooled = {
+        'mean': (last_hidden * mask).sum(dim=1) / mask.sum(dim=1).clamp(min=1),
+        'cls': last_hidden[:, 0],
+        'max': last_hidden.masked_fill(mask == 0, float('-inf')).amax(dim=1)
+    }
+    return torch.stack([pooled[view['name']] for view in EMBEDDING_VIEWS], dim=1)
+
+def get_embeddings(texts, tokenizer, model):
+    """Get pooled embedding views for a batch of texts using a specific model.
+
+    Texts are sorted by token count and run in sub-batches spanning at most
+    EMBED_BUCKET_WIDTH tokens, each padded only to its own longest member,
+    so one long text doesn't make every other text pay for its padding.
+    """
+    encodings = tokenizer(texts, truncation=True, max_length=512, padding=False)['input_ids']
+    lengths = np.array([len(ids) for ids in encodings])
+    order = np.argsort(lengths, kind='stable')
+    pad_token_id = tokenizer.pad_token_id or 0
+
+    pooled = None
+    start = 0
+    while start < len(order):
+        end = start + 1
+        while end < len(order) and lengths[order[end]] - lengths[order[start]] < EMBED_BUCKET_WIDTH:
+            end += 1
+        bucket = order[start:end]
+
+        # BERT pads on the right
+        width = lengths[bucket[-1]]
+        input_ids = np.full((len(bucket), width), pad_token_id, dtype=np.int64)
+        attention_mask = np.zeros((len(bucket), width), dtype=np.int64)
+        for row, index in enumerate(bucket):
+            input_ids[row, :lengths[index]] = encodings[index]
+            attention_mask[row, :lengths[index]] = 1
+
+        views = encode_batch(input_ids, attention_mask, model)
+        if pooled is None:
+            pooled = torch.empty((len(texts),) + views.shape[1:], dtype=views.dtype)
+        # Scatter back to the caller's order
+        pooled[torch.from_numpy(bucket)] = views
+        start = end
+
+    return pooled
+
+def encode_batch(input_ids, attention_mask, model):
+    """Run one padded batch through the model and pool it into embedding views"""
+    with torch.inference_mode():
+        if ort is not None and isinstance(model, ort.InferenceSession):
+            last_hidden = torch.from_numpy(
+                model.run(None, {'input_ids': input_ids, 'attention_mask': attention_mask})[0]
+            )
+        else:
+            with inference_autocast():
+                # Positional call works for both eager and TorchScript-traced models
+                outputs = model(torch.from_numpy(input_ids), torch.from_numpy(attention_mask))
+            # Cast back so pooling and the scoring matmul stay in float32
+            last_hidden = outputs['last_hidden_state'].float()
+
+        return pool_hidden_states(last_hidden, torch.from_numpy(attention_mask))
+
+class EmbeddingBatcher:
+    """Coalesce concurrent embedding requests for one model into a single forward pass.
+
+    Request threads call embed() and block until a background worker has run
+    the batch they were collected into. The worker waits up to
+    EMBED_BATCH_WINDOW_MS after the first queued text for others to arrive.
+    """
+
+    def __init__(self, model_config):
+        self.model_config = model_config
+        self.window = EMBED_BATCH_WINDOW_MS / 1000.0
+        self.max_batch_size = EMBED_MAX_BATCH_SIZE
+        self._queue = queue.Queue()
+        self._lock = threading.Lock()
+        self._worker = None
+
+    def embed(self, text):
+        """Return the embedding for a single text, batched with concurrent callers"""
+        self._ensure_worker()
+        future = Future()
+        self._queue.put((text, future))
+        return future.result()
+
+    def _ensure_worker(self):
+        # Started lazily so a forked server process gets its own worker thread
+        with self._lock:
+            if self._worker is None or not self._worker.is_alive():
+                self._worker = threading.Thread(
+                    target=self._run,
+                    name=f"embedding-batcher-{self.model_config['name']}",
+                    daemon=True
+                )
+                self._worker.start()
+
+    def _collect_batch(self):
+        batch = [self._queue.get()]
+        deadline = time.monotonic() + self.window
+        while len(batch) < self.max_batch_size:
+            remaining = deadline - time.monotonic()
+            try:
+                if remaining > 0:
+                    batch.append(self._queue.get(timeout=remaining))
+                else:
+                    batch.append(self._queue.get_nowait())
+            except queue.Empty:
+                break
+        return batch
 
-    for keyword in symptom_keywords:
-        if keyword in symptoms_lower:
-            keywords.append(keyword)
+    def _run(self):
+        while True:
+            batch = self._collect_batch()
+            texts = [text for text, _ in batch]
+            try:
+                embeddings = get_embeddings(
+                    texts,
+                    self.model_config['tokenizer'],
+                    self.model_config['model']
+                )
+            except Exception as e:
+                for _, future in batch:
+                    future.set_exception(e)
+                continue
 
-    return keywords
+            for (_, future), embedding in zip(batch, embeddings):
+                future.set_result(embedding)
 
 def get_patient_history(patient_id):
     """Get patient's medical history"""
-    with closing(get_db()) as conn:
+    with get_db() as conn:
         cursor = conn.cursor()
         cursor.execute('''
             SELECT symptoms, predicted_disease, confidence, created_at
@@ -1148,6 +1722,51 @@ def get_patient_history(patient_id):
         ''', (patient_id,))
         return [dict(row) for row in cursor.fetchall()]
 
+def normalize_symptom_text(text, lowercase):
+    """Canonical form of the input used as the embedding cache key.
+
+    Collapsing whitespace never changes the BERT tokens; lowercasing is only
+    applied for tokenizers that lowercase anyway, so a cache hit always
+    returns what the model would have computed.
+    """
+    text = re.sub(r'\s+', ' ', text.strip())
+    return text.lower() if lowercase else text
+
+def get_model_config(model_key):
+    """Look up a loaded model's config by name"""
+    for model_config in get_loaded_models():
+        if model_config['name'] == model_key:
+            return model_config
+    raise KeyError(f"Model {model_key} is not loaded")
+
+@functools.lru_cache(maxsize=EMBEDDING_CACHE_SIZE)
+def _embed_cached(model_key, normalized_text):
+    """Unit-normalized float32 embedding views for a text, shape (views, hidden).
+
+    The tensor is shared by every caller that hits the cache, so it must
+    never be modified in place.
+    """
+    model_config = get_model_config(model_key)
+    # Batched with concurrent requests on a cache miss
+    views = model_config['batcher'].embed(normalized_text)
+    return F.normalize(views, dim=-1)
+
+def _score_with_model(model_config, symptoms_text):
+    """Score every disease against the symptoms with one model; returns (score vector, weight)"""
+    # Get embedding views for input symptoms, reusing cached ones for repeated inputs
+    lowercase = getattr(model_config['tokenizer'], 'do_lower_case', False)
+    normalized_text = normalize_symptom_text(symptoms_text, lowercase)
+    symptom_views = _embed_cached(model_config['name'], normalized_text)
+
+    with torch.inference_mode():
+        # Disease embeddings are unit vectors, so cosine similarity is one batched
+        # matrix-vector product: (views, diseases, hidden) @ (views, hidden, 1)
+        similarities = torch.matmul(model_config['disease_mat'], symptom_views.unsqueeze(-1)).squeeze(-1)
+
+        # Weighted vote of the views; disease_mat rows follow DISEASE_LIST, so this is aligned with it
+        disease_scores = VIEW_WEIGHTS @ similarities.clamp(min=0)
+    return disease_scores.numpy(), model_config['weight']
+
 def predict_disease_ml(symptoms_text, patient_history=None):
     """Ensemble ML-based prediction using multiple models with optional patient history"""
     loaded_models = get_loaded_models()
@@ -1176,41 +1795,30 @@ def predict_disease_ml(symptoms_text, patient_history=None):
             enhanced_symptoms = symptoms_text
             previous_diseases = {}
 
-        # Extract symptom keywords for enhanced matching
-        symptom_keywords = extract_symptoms_keywords(symptoms_text)
+        # One phrase scan serves both the simple and the keyword matching below
+        matches = match_symptom_phrases(symptoms_text)
 
         # Ensemble prediction: get predictions from all loaded models
-        ensemble_scores = {}
+        ensemble_vec = np.zeros(len(DISEASE_LIST), dtype=np.float32)
         total_weight = 0
 
-        for model_config in loaded_models:
+        # Models share no state, so run their forward passes concurrently: the
+        # extra backbones on the pool, the first one on this request thread, so
+        # a single-model setup never queues behind other requests
+        pending = [
+            (model_config, _ensemble_pool.submit(_score_with_model, model_config, enhanced_symptoms))
+            for model_config in loaded_models[1:]
+        ]
+        pending.insert(0, (loaded_models[0], None))
+        for model_config, future in pending:
             try:
-                tokenizer = model_config['tokenizer']
-                model = model_config['model']
-                weight = model_config['weight']
-
-                # Get embedding for input symptoms
-                symptom_embedding = get_embedding(enhanced_symptoms, tokenizer, model)
-                symptom_embedding = symptom_embedding.reshape(1, -1)
-
-                # Get embeddings for each disease's typical symptoms
-                disease_scores = {}
-                for disease, typical_symptoms in DISEASE_SYMPTOMS.items():
-                    # Create a text description of the disease and its symptoms
-                    disease_text = f"{disease}: {', '.join(typical_symptoms)}"
-                    disease_emb = get_embedding(disease_text, tokenizer, model)
-                    disease_emb = disease_emb.reshape(1, -1)
-
-                    # Calculate cosine similarity
-                    similarity = cosine_similarity(symptom_embedding, disease_emb)[0][0]
-                    disease_scores[disease] = max(0, similarity)
+                if future is None:
+                    disease_scores, weight = _score_with_model(model_config, enhanced_symptoms)
+                else:
+                    disease_scores, weight = future.result()
 
                 # Weight and accumulate scores
-                for disease, score in disease_scores.items():
-                    if disease not in ensemble_scores:
-                        ensemble_scores[disease] = 0
-                    ensemble_scores[disease] += score * weight
-
+                ensemble_vec += disease_scores * weight
                 total_weight += weight
 
             except Exception as e:
@@ -1219,53 +1827,36 @@ def predict_disease_ml(symptoms_text, patient_history=None):
 
         # Normalize by total weight
         if total_weight > 0:
-            for disease in ensemble_scores:
-                ensemble_scores[disease] /= total_weight
-
-        # Combine with symptom matching (weighted combination)
-        simple_scores = predict_disease_simple(symptoms_text)
-        simple_dict = dict(simple_scores)
-
-        # Enhanced keyword matching
-        keyword_scores = {}
-        for disease, typical_symptoms in DISEASE_SYMPTOMS.items():
-            keyword_match = 0
-            for symptom in typical_symptoms:
-                if any(keyword in symptom.lower() for keyword in symptom_keywords):
-                    keyword_match += 1
-            if keyword_match > 0:
-                keyword_scores[disease] = keyword_match / len(typical_symptoms)
-
-        # Merge ensemble, simple, and keyword scores
-        final_scores = {}
-        for disease in DISEASE_SYMPTOMS.keys():
-            ensemble_score = ensemble_scores.get(disease, 0)
-            simple_score = simple_dict.get(disease, 0)
-            keyword_score = keyword_scores.get(disease, 0)
-
-            # Weighted combination: 50% ensemble, 30% simple, 20% keyword matching
-            base_score = (ensemble_score * 0.5) + (simple_score * 0.3) + (keyword_score * 0.2)
-
-            # Boost score if patient has history of this disease
-            if disease in previous_diseases:
-                avg_prev_confidence = sum(previous_diseases[disease]) / len(previous_diseases[disease])
-                # Boost by up to 25% based on previous occurrences
-                history_boost = min(0.25, avg_prev_confidence * 0.25)
-                base_score = min(1.0, base_score + history_boost)
-
-            final_scores[disease] = base_score
-
-        # Filter out zero scores and sort
-        final_scores = {k: v for k, v in final_scores.items() if v > 0}
-        sorted_diseases = sorted(final_scores.items(), key=lambda x: x[1], reverse=True)
-
-        # Normalize scores to 0-1 range
-        if sorted_diseases:
-            max_score = sorted_diseases[0][1]
-            if max_score > 0:
-                sorted_diseases = [(d, float(min(1.0, s / max_score))) for d, s in sorted_diseases]
-
-        return sorted_diseases[:3]
+            ensemble_vec /= total_weight
+
+        # Combine with symptom matching (weighted combination); like
+        # predict_disease_simple, only its top 3 diseases contribute
+        simple_all = symptom_mask_vector(patient_symptom_mask(matches))
+        simple_top = np.argsort(-simple_all, kind='stable')[:3]
+        simple_vec = np.zeros_like(simple_all)
+        simple_vec[simple_top] = simple_all[simple_top]
+
+        # Enhanced keyword matching: disease symptoms containing any extracted keyword
+        keyword_mask = reduce(or_, (KEYWORD_MASKS.get(phrase, 0) for phrase in matches), 0)
+        keyword_vec = symptom_mask_vector(keyword_mask)
+
+        # Boost by up to 25% for diseases in the patient's history
+        history_boost_vec = np.zeros(len(DISEASE_LIST), dtype=np.float32)
+        for disease, confidences in previous_diseases.items():
+            if disease in DISEASE_INDEX:
+                avg_prev_confidence = sum(confidences) / len(confidences)
+                history_boost_vec[DISEASE_INDEX[disease]] = min(0.25, avg_prev_confidence * 0.25)
+
+        # Weighted combination: 50% ensemble, 30% simple, 20% keyword matching
+        base = 0.5 * ensemble_vec + 0.3 * simple_vec + 0.2 * keyword_vec
+        final = np.minimum(1.0, base + history_boost_vec)
+
+        # Top 3 non-zero scores, normalized to the 0-1 range
+        top = [i for i in np.argsort(-final, kind='stable')[:3] if final[i] > 0]
+        if not top:
+            return []
+        max_score = final[top[0]]
+        return [(DISEASE_LIST[i], float(min(1.0, final[i] / max_score))) for i in top]
 
     except Exception as e:
         print(f"Ensemble ML prediction error: {e}")
@@ -1331,29 +1922,8 @@ def predict():
                 top_prediction = result
 
         # Update performance metrics (for real-time dashboard)
-        import time
-        if not hasattr(app, 'prediction_stats'):
-            from collections import Counter
-            app.prediction_stats = {
-                'total_predictions': 0,
-                'successful_predictions': 0,
-                'failed_predictions': 0,
-                'disease_counts': Counter(),
-                'avg_confidence': 0.0,
-                'response_times': [],
-                'start_time': time.time()
-            }
-
         if top_prediction:
-            stats = app.prediction_stats
-            stats['total_predictions'] += 1
-            stats['successful_predictions'] += 1
-            stats['disease_counts'][top_prediction['disease']] += 1
-
-            # Update rolling average confidence
-            current_avg = stats['avg_confidence']
-            new_confidence = top_prediction['confidence'] / 100.0
-            stats['avg_confidence'] = (current_avg * (stats['total_predictions'] - 1) + new_confidence) / stats['total_predictions']
+            app.prediction_stats.record_success(top_prediction['disease'], top_prediction['confidence'] / 100.0)
 
         response = {
             'predictions': results,
@@ -1362,33 +1932,17 @@ def predict():
 
         # Save to database if patient_id is provided
         if patient_id and top_prediction:
-            try:
-                with closing(get_db()) as conn:
-                    cursor = conn.cursor()
-                    cursor.execute('''
-                        INSERT INTO medical_history (patient_id, symptoms, predicted_disease, confidence)
-                        VALUES (?, ?, ?, ?)
-                    ''', (patient_id, symptoms, top_prediction['disease'], top_prediction['confidence'] / 100.0))
-                    conn.commit()
-            except Exception as e:
-                logger.error(f"Error saving to database: {e}")
+            save_history(patient_id, symptoms, top_prediction['disease'], top_prediction['confidence'] / 100.0)
 
         # Track response time
         response_time = time.time() - start_time
-        if hasattr(app, 'prediction_stats'):
-            stats = app.prediction_stats
-            stats['response_times'].append(response_time)
-            # Keep only last 1000 response times to avoid memory issues
-            if len(stats['response_times']) > 1000:
-                stats['response_times'] = stats['response_times'][-1000:]
+        app.prediction_stats.record_response_time(response_time)
 
         return jsonify(response)
 
     except Exception as e:
         # Track failed predictions
-        if hasattr(app, 'prediction_stats'):
-            app.prediction_stats['total_predictions'] += 1
-            app.prediction_stats['failed_predictions'] += 1
+        app.prediction_stats.record_failure()
 
         logger.error(f"Prediction error: {str(e)}", exc_info=True)
         return jsonify({
@@ -1409,7 +1963,7 @@ def register_patient():
                 'error': 'Patient ID is required'
             }), 400
 
-        with closing(get_db()) as conn:
+        with get_db() as conn:
             cursor = conn.cursor()
             try:
                 cursor.execute('''
@@ -1435,7 +1989,7 @@ def register_patient():
 def get_patient(patient_id):
     """Get patient information and history"""
     try:
-        with closing(get_db()) as conn:
+        with get_db() as conn:
             cursor = conn.cursor()
             cursor.execute('SELECT * FROM patients WHERE patient_id = ?', (patient_id,))
             patient = cursor.fetchone()
@@ -1477,7 +2031,7 @@ def get_patient_history_endpoint(patient_id):
 def clear_patient_history(patient_id):
     """Clear patient's medical history"""
     try:
-        with closing(get_db()) as conn:
+        with get_db() as conn:
             cursor = conn.cursor()
             # Check if patient exists
             cursor.execute('SELECT * FROM patients WHERE patient_id = ?', (patient_id,))
@@ -1512,49 +2066,26 @@ def health():
         'status': 'healthy',
         'models_loaded': len(loaded_models),
         'model_names': [m['name'] for m in loaded_models],
-        'ensemble_mode': len(loaded_models) > 1
+        'ensemble_views': [view['name'] for view in EMBEDDING_VIEWS] if loaded_models else [],
+        'ensemble_mode': len(loaded_models) * len(EMBEDDING_VIEWS) > 1
     })
 
-@app.route('/metrics', methods=['GET'])
-def metrics():
-    """Prometheus-compatible metrics endpoint for monitoring"""
-    import time
-    from collections import Counter
-
-    # Get prediction statistics (in-memory, could be moved to Redis/DB)
-    if not hasattr(app, 'prediction_stats'):
-        app.prediction_stats = {
-            'total_predictions': 0,
-            'successful_predictions': 0,
-            'failed_predictions': 0,
-            'disease_counts': Counter(),
-            'avg_confidence': 0.0,
-            'response_times': [],
-            'start_time': time.time()
-        }
-
-    stats = app.prediction_stats
-    uptime = time.time() - stats['start_time']
-
-    # Calculate average response time
-    avg_response_time = sum(stats['response_times'][-100:]) / len(stats['response_times']) if stats['response_times'] else 0
-
-    # Prometheus format metrics
-    metrics_output = f"""# HELP disease_detector_total_predictions Total number of predictions made
+# Static part of the /metrics output; only the values change between scrapes
+METRICS_TEMPLATE = """# HELP disease_detector_total_predictions Total number of predictions made
 # TYPE disease_detector_total_predictions counter
-disease_detector_total_predictions {stats['total_predictions']}
+disease_detector_total_predictions {total_predictions}
 
 # HELP disease_detector_successful_predictions Number of successful predictions
 # TYPE disease_detector_successful_predictions counter
-disease_detector_successful_predictions {stats['successful_predictions']}
+disease_detector_successful_predictions {successful_predictions}
 
 # HELP disease_detector_failed_predictions Number of failed predictions
 # TYPE disease_detector_failed_predictions counter
-disease_detector_failed_predictions {stats['failed_predictions']}
+disease_detector_failed_predictions {failed_predictions}
 
 # HELP disease_detector_avg_confidence Average prediction confidence
 # TYPE disease_detector_avg_confidence gauge
-disease_detector_avg_confidence {stats['avg_confidence']}
+disease_detector_avg_confidence {avg_confidence}
 
 # HELP disease_detector_avg_response_time Average response time in seconds
 # TYPE disease_detector_avg_response_time gauge
@@ -1566,17 +2097,40 @@ disease_detector_uptime_seconds {uptime}
 
 # HELP disease_detector_models_loaded Number of ML models loaded
 # TYPE disease_detector_models_loaded gauge
-disease_detector_models_loaded {len(get_loaded_models())}
+disease_detector_models_loaded {models_loaded}
 """
 
-    # Add disease-specific metrics
-    for disease, count in stats['disease_counts'].most_common(10):
-        disease_safe = disease.lower().replace(' ', '_')
-        metrics_output += f"""
-# HELP disease_detector_disease_predictions Predictions per disease
-# TYPE disease_detector_disease_predictions counter
-disease_detector_disease_predictions{{disease="{disease_safe}"}} {count}
-"""
+@app.route('/metrics', methods=['GET'])
+def metrics():
+    """Prometheus-compatible metrics endpoint for monitoring"""
+    import time
+
+    # Get prediction statistics (shared by all worker processes)
+    stats = app.prediction_stats.snapshot()
+    uptime = time.time() - stats['start_time']
+
+    # Prometheus format metrics
+    metrics_output = METRICS_TEMPLATE.format(
+        total_predictions=stats['total_predictions'],
+        successful_predictions=stats['successful_predictions'],
+        failed_predictions=stats['failed_predictions'],
+        avg_confidence=stats['avg_confidence'],
+        avg_response_time=stats['avg_response_time'],
+        uptime=uptime,
+        models_loaded=len(get_loaded_models())
+    )
+
+    # Add disease-specific metrics under a single HELP/TYPE header
+    top_diseases = stats['disease_counts'].most_common(10)
+    if top_diseases:
+        parts = [
+            metrics_output,
+            '# HELP disease_detector_disease_predictions Predictions per disease',
+            '# TYPE disease_detector_disease_predictions counter'
+        ]
+        for disease, count in top_diseases:
+            parts.append(f'disease_detector_disease_predictions{{disease="{DISEASE_LABEL[disease]}"}} {count}')
+        metrics_output = '\n'.join(parts) + '\n'
 
     return metrics_output, 200, {'Content-Type': 'text/plain; version=0.0.4'}
 
@@ -1585,17 +2139,17 @@ def performance_dashboard():
     """Real-time performance dashboard data"""
     import time
 
-    if not hasattr(app, 'prediction_stats'):
+    stats = app.prediction_stats.snapshot()
+    if not stats['total_predictions']:
         return jsonify({'error': 'No statistics available'}), 404
 
-    stats = app.prediction_stats
     uptime = time.time() - stats['start_time']
 
     # Calculate success rate
-    success_rate = (stats['successful_predictions'] / stats['total_predictions'] * 100) if stats['total_predictions'] > 0 else 0
+    success_rate = stats['successful_predictions'] / stats['total_predictions'] * 100
 
     # Calculate average response time
-    avg_response_time = sum(stats['response_times'][-100:]) / len(stats['response_times']) if stats['response_times'] else 0
+    avg_response_time = stats['avg_response_time']
 
     # Get top predicted diseases
     top_diseases = [{'disease': disease, 'count': count}
@@ -0,0 +1,44 @@
+"""
+Gunicorn settings for the Disease Detector backend
+
+Run with: gunicorn -c gunicorn.conf.py app:app
+
+The app is preloaded and the models are loaded once in the master process
+before the workers are forked, so every worker shares the model weights
+copy-on-write instead of loading its own copy. Preloading also lets the
+workers share the prediction statistics, which are allocated in shared
+memory at import.
+"""
+
+import multiprocessing
+import os
+
+# Parallelism comes from the worker processes, so each worker keeps a single
+# torch / ONNX Runtime thread to avoid oversubscribing the cores. This has to
+# be set before app is imported, since app applies it at import time.
+os.environ.setdefault('TORCH_NUM_THREADS', '1')
+
+bind = os.getenv('GUNICORN_BIND', '0.0.0.0:5001')
+workers = int(os.getenv('GUNICORN_WORKERS', multiprocessing.cpu_count()))
+threads = int(os.getenv('GUNICORN_THREADS', '4'))
+worker_class = 'gthread'
+preload_app = True
+timeout = int(os.getenv('GUNICORN_TIMEOUT', '120'))
+
+
+def on_starting(server):
+    """Initialize the database and load the models in the master, pre-fork"""
+    import app
+
+    app.init_db()
+    app.load_models()
+
+
+def post_fork(server, worker):
+    """Per-worker setup: torch thread count and a log file of its own"""
+    import torch
+    import app
+
+    torch.set_num_threads(int(os.environ['TORCH_NUM_THREADS']))
+    # Rotating the master's shared log file from several processes is unsafe
+    app.use_worker_log_file()
@@ -72,78 +72,434 @@ Unit tests for Disease Detector Application
 These tests are run during CI/CD pipeline
 """
 
-import os
-import tempfile
+import io
+import re
+import sys
+import threading
+import zlib
+from concurrent.futures import ThreadPoolExecutor
 import pytest
-import json
-from app import app, DISEASE_SYMPTOMS, init_db
+import orjson
+import torch
+import torch.nn.functional as F
+from transformers import BertConfig, BertModel, BertTokenizer
+from flask.json.provider import DefaultJSONProvider
+from app import (
+    app, DISEASE_SYMPTOMS, MODELS_CONFIG, init_db,
+    EmbeddingBatcher, compute_disease_embeddings, get_embeddings, load_model,
+    normalize_symptom_text, _embed_cached, get_db,
+    PredictionStats
+)
 
-@pytest.fixture(autouse=True)
-def _init_test_db(monkeypatch, tmp_path):
-    """Use an isolated sqlite DB for tests and initialize schema."""
-    db_path = tmp_path / "test_patients.db"
-    monkeypatch.setenv("DATABASE_PATH", str(db_path))
-    # Repoint app global if it was already read
-    monkeypatch.setattr("app.DATABASE", str(db_path), raising=False)
-    init_db()
-    yield
+@pytest.fixture(scope="session", autouse=True)
+def _init_test_db(tmp_path_factory):
+    """Use an isolated sqlite DB for the test session and initialize schema."""
+    # Session-scoped so session fixtures such as registered_patient write to
+    # the same DB the tests read from
+    db_path = tmp_path_factory.mktemp("db") / "test_patients.db"
+    with pytest.MonkeyPatch.context() as monkeypatch:
+        monkeypatch.setenv("DATABASE_PATH", str(db_path))
+        # Repoint app global if it was already read
+        monkeypatch.setattr("app.DATABASE", str(db_path), raising=False)
+        init_db()
+        yield
 
 
-@pytest.fixture
+class OrjsonProvider(DefaultJSONProvider):
+    """JSON provider backed by orjson for jsonify() and get_json()"""
+
+    def dumps(self, obj, **kwargs):
+        # Formatting kwargs (indent/separators) are ignored; orjson is always compact
+        return orjson.dumps(obj, default=self.default, option=orjson.OPT_SORT_KEYS).decode()
+
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
+
+
+app.config['TESTING'] = True
+app.json = OrjsonProvider(app)
+# Built once at import; the tests only issue requests, so the client needs no
+# context-manager setup or teardown
+_client = app.test_client()
+
+# Request bodies are constants, so they are serialized once here
+_PATIENT_ID = 'TEST001'
+_EMPTY = b'{}'
+_SYMPTOMS = orjson.dumps({'symptoms': 'fever, cough, headache'})
+_REGISTER = orjson.dumps({'patient_id': _PATIENT_ID, 'name': 'Test Patient'})
+_PATIENT_SYMPTOMS = orjson.dumps({'symptoms': 'fever, cough', 'patient_id': _PATIENT_ID})
+
+# Expected response fragments. OrjsonProvider writes compact JSON, so a field
+# always appears exactly as "key":value in the body.
+_HEALTHY = b'"status":"healthy"'
+
+# Fixed part of the WSGI environ for JSON POSTs issued by wsgi_post()
+_POST_ENVIRON = {
+    'REQUEST_METHOD': 'POST',
+    'SCRIPT_NAME': '',
+    'QUERY_STRING': '',
+    'CONTENT_TYPE': 'application/json',
+    'SERVER_NAME': 'localhost',
+    'SERVER_PORT': '80',
+    'SERVER_PROTOCOL': 'HTTP/1.1',
+    'HTTP_HOST': 'localhost',
+    'REMOTE_ADDR': '127.0.0.1',
+    'wsgi.version': (1, 0),
+    'wsgi.url_scheme': 'http',
+    'wsgi.errors': sys.stderr,
+    'wsgi.multithread': False,
+    'wsgi.multiprocess': False,
+    'wsgi.run_once': False,
+}
+
+
+def wsgi_post(path, body):
+    """POST a JSON body straight to app.wsgi_app; returns (status code, body bytes).
+
+    Skips the test client's per-request EnvironBuilder and response wrapping.
+    """
+    environ = dict(_POST_ENVIRON, PATH_INFO=path, CONTENT_LENGTH=str(len(body)))
+    environ['wsgi.input'] = io.BytesIO(body)
+    status = []
+
+    def start_response(status_line, headers, exc_info=None):
+        status.append(status_line)
+
+    app_iter = app.wsgi_app(environ, start_response)
+    try:
+        data = b''.join(app_iter)
+    finally:
+        if hasattr(app_iter, 'close'):
+            app_iter.close()
+    return int(status[0].split(' ', 1)[0]), data
+
+
+@pytest.fixture(scope="session")
 def client():
-    """Create test client"""
-    app.config['TESTING'] = True
-    with app.test_client() as client:
-        yield client
+    """Test client shared by the whole session"""
+    return _client
+
+@pytest.fixture(scope="session")
+def registered_patient(client):
+    """Register the test patient once and return its ID"""
+    client.post('/patient/register',
+                data=_REGISTER,
+                content_type='application/json')
+    return _PATIENT_ID
+
+
+class FakeTokenizer:
+    """Lowercasing word tokenizer standing in for an uncased BERT tokenizer"""
+
+    do_lower_case = True
+    pad_token_id = 0
+
+    def __call__(self, texts, truncation=True, max_length=512, padding=False):
+        input_ids = []
+        for text in texts:
+            words = re.findall(r'\w+|[^\w\s]', text.lower())
+            ids = [zlib.crc32(word.encode()) % 997 + 3 for word in words]
+            input_ids.append([1] + ids[:max_length - 2] + [2])
+        return {'input_ids': input_ids}
+
+
+class TinyBert(torch.nn.Module):
+    """Randomly initialised one-layer BERT; records every batch size"""
+
+    def __init__(self):
+        super().__init__()
+        torch.manual_seed(0)
+        self.bert = BertModel(BertConfig(
+            hidden_size=16, num_hidden_layers=1, num_attention_heads=2,
+            intermediate_size=32, vocab_size=1000,
+        )).eval()
+        self.batch_sizes = []
+
+    def forward(self, input_ids, attention_mask):
+        self.batch_sizes.append(input_ids.shape[0])
+        return self.bert(input_ids=input_ids, attention_mask=attention_mask)
+
+
+@pytest.fixture
+def fake_model(monkeypatch):
+    """Load a tiny BERT as the only model for one test"""
+    model_config = MODELS_CONFIG[0]
+    tokenizer, model = FakeTokenizer(), TinyBert()
+    monkeypatch.setitem(model_config, 'tokenizer', tokenizer)
+    monkeypatch.setitem(model_config, 'model', model)
+    monkeypatch.setitem(model_config, 'disease_mat', compute_disease_embeddings(tokenizer, model))
+    monkeypatch.setitem(model_config, 'batcher', EmbeddingBatcher(model_config))
+    model.batch_sizes.clear()
+    _embed_cached.cache_clear()
+    yield model_config
+    _embed_cached.cache_clear()
 
 def test_health_endpoint(client):
     """Test health check endpoint"""
     response = client.get('/health')
     assert response.status_code == 200
-    data = json.loads(response.data)
-    assert 'status' in data
-    assert data['status'] == 'healthy'
-
-def test_predict_endpoint_missing_symptoms(client):
-    """Test predict endpoint with missing symptoms"""
-    response = client.post('/predict',
-                         json={},
-                         content_type='application/json')
-    assert response.status_code == 400
-    data = json.loads(response.data)
-    assert 'error' in data
-
-def test_predict_endpoint_with_symptoms(client):
-    """Test predict endpoint with symptoms"""
-    response = client.post('/predict',
-                         json={'symptoms': 'fever, cough, headache'},
-                         content_type='application/json')
-    assert response.status_code == 200
-    data = json.loads(response.data)
-    assert 'predictions' in data
-    assert len(data['predictions']) > 0
+    assert _HEALTHY in response.data
+
+@pytest.mark.parametrize('body, expected_status, expected_key', [
+    (_EMPTY, 400, 'error'),
+    (_SYMPTOMS, 200, 'predictions'),
+    # Carries the ID of the registered_patient fixture
+    (_PATIENT_SYMPTOMS, 200, 'predictions'),
+], ids=['missing_symptoms', 'with_symptoms', 'with_patient_id'])
+def test_predict(registered_patient, body, expected_status, expected_key):
+    """Test predict endpoint with missing symptoms, symptoms, and a patient ID"""
+    status_code, response_data = wsgi_post('/predict', body)
+    assert status_code == expected_status
+    data = orjson.loads(response_data)
+    assert expected_key in data
+    assert len(data[expected_key]) > 0
 
 def test_disease_symptoms_defined():
     """Test that disease symptoms are properly defined"""
     assert len(DISEASE_SYMPTOMS) > 0
-    for disease, symptoms in DISEASE_SYMPTOMS.items():
-        assert isinstance(symptoms, list)
-        assert len(symptoms) > 0
-
-def test_predict_with_patient_id(client):
-    """Test predict endpoint with patient ID"""
-    # First register a patient
-    register_response = client.post('/patient/register',
-                                   json={'patient_id': 'TEST001', 'name': 'Test Patient'},
-                                   content_type='application/json')
-
-    # Then make prediction
-    response = client.post('/predict',
-                         json={
-                             'symptoms': 'fever, cough',
-                             'patient_id': 'TEST001'
-                         },
-                         content_type='application/json')
+    assert all(isinstance(symptoms, list) and symptoms for symptoms in DISEASE_SYMPTOMS.values())
+
+def test_concurrent_predictions_share_one_batch(fake_model):
+    """Concurrent /predict calls are coalesced into a single forward pass"""
+    concurrency = 8
+    batcher = fake_model['batcher']
+    # Run the batch as soon as every request has arrived; the long window
+    # only bounds the wait if one of them never reaches the batcher
+    batcher.max_batch_size = concurrency
+    batcher.window = 5.0
+    # Distinct texts of equal token length: no cache hits, one length bucket
+    bodies = [orjson.dumps({'symptoms': f'fever and cough since day {i}'}) for i in range(concurrency)]
+    barrier = threading.Barrier(concurrency)
+
+    def post(body):
+        barrier.wait()
+        return wsgi_post('/predict', body)[0]
+
+    with ThreadPoolExecutor(concurrency) as pool:
+        statuses = list(pool.map(post, bodies))
+
+    assert statuses == [200] * concurrency
+    assert fake_model['model'].batch_sizes == [concurrency]
+
+def test_bucketed_and_cached_embeddings_match_unbatched(fake_model):
+    """Length bucketing keeps input order and cache keys only merge equivalent texts"""
+    tokenizer, model = fake_model['tokenizer'], fake_model['model']
+    texts = [
+        'fever',
+        'runny nose and sneezing',
+        'nausea, vomiting and diarrhea with severe abdominal pain ' * 4,
+        'cough',
+        'headache with sensitivity to light',
+    ]
+    unbatched = [get_embeddings([text], tokenizer, model)[0] for text in texts]
+
+    # Permuted input spanning several length buckets comes back in input order,
+    # and texts padded within a shared bucket match their unpadded embedding
+    order = [2, 3, 0, 4, 1]
+    model.batch_sizes.clear()
+    batched = get_embeddings([texts[i] for i in order], tokenizer, model)
+    assert len(model.batch_sizes) > 1 and max(model.batch_sizes) > 1
+    for row, i in enumerate(order):
+        assert torch.allclose(batched[row], unbatched[i], atol=1e-5)
+
+    # Case and whitespace variants share one cache entry, equal to what an
+    # uncached call on the raw text computes
+    variants = ['Runny Nose  and\tSNEEZING', ' runny nose and sneezing ']
+    for variant in variants:
+        key = normalize_symptom_text(variant, tokenizer.do_lower_case)
+        cached = _embed_cached(fake_model['name'], key)
+        uncached = F.normalize(get_embeddings([variant], tokenizer, model)[0], dim=-1)
+        assert torch.allclose(cached, uncached, atol=1e-5)
+    assert _embed_cached.cache_info().currsize == 1
+
+    # Cased tokenizers keep the case in the cache key
+    assert normalize_symptom_text('Runny  Nose', False) == 'Runny Nose'
+
+@pytest.fixture(scope="session")
+def tiny_checkpoint(tmp_path_factory):
+    """Save a tiny BERT and a WordPiece vocab of the disease texts' words"""
+    path = tmp_path_factory.mktemp("tiny-bert")
+    words = sorted({
+        word
+        for disease, symptoms in DISEASE_SYMPTOMS.items()
+        for word in re.findall(r'\w+|[^\w\s]', f"{disease}: {', '.join(symptoms)}".lower())
+    })
+    vocab_file = path / "vocab.txt"
+    vocab_file.write_text('\n'.join(['[PAD]', '[UNK]', '[CLS]', '[SEP]', '[MASK]'] + words) + '\n')
+    BertTokenizer(str(vocab_file)).save_pretrained(path)
+    torch.manual_seed(0)
+    BertModel(BertConfig(
+        hidden_size=16, num_hidden_layers=1, num_attention_heads=2,
+        intermediate_size=32, vocab_size=5 + len(words),
+    )).save_pretrained(path)
+    return str(path)
+
+def _tiny_model_config(path):
+    return {'name': 'tiny', 'model_name': path, 'weight': 1.0, 'tokenizer': None, 'model': None}
+
+def test_load_model_caches_onnx_export(tiny_checkpoint, tmp_path, monkeypatch):
+    """The quantized ONNX graph is reused on the next load and a corrupt one is dropped"""
+    ort = pytest.importorskip('onnxruntime')
+    monkeypatch.setattr('app.USE_ONNX_RUNTIME', True)
+    monkeypatch.setattr('app.ONNX_MODEL_DIR', str(tmp_path))
+
+    exported = _tiny_model_config(tiny_checkpoint)
+    load_model(exported)
+    assert isinstance(exported['model'], ort.InferenceSession)
+    cached_files = list(tmp_path.glob('tiny.*.int8.onnx'))
+    assert len(cached_files) == 1
+    # Scratch files from the export are cleaned up
+    assert list(tmp_path.iterdir()) == cached_files
+
+    def fail_export(model, quantized_path):
+        pytest.fail('cached ONNX graph was re-exported')
+
+    # A cache hit loads the same graph, so it scores identically
+    with monkeypatch.context() as patch:
+        patch.setattr('app.export_quantized_onnx', fail_export)
+        cached = _tiny_model_config(tiny_checkpoint)
+        load_model(cached)
+    assert isinstance(cached['model'], ort.InferenceSession)
+    assert torch.equal(cached['disease_mat'], exported['disease_mat'])
+    query = ['fever and cough']
+    assert torch.equal(
+        get_embeddings(query, cached['tokenizer'], cached['model']),
+        get_embeddings(query, exported['tokenizer'], exported['model']),
+    )
+
+    # A truncated graph falls back to the torch path and is deleted
+    cached_files[0].write_bytes(cached_files[0].read_bytes()[:64])
+    fallback = _tiny_model_config(tiny_checkpoint)
+    load_model(fallback)
+    assert not isinstance(fallback['model'], ort.InferenceSession)
+    assert not cached_files[0].exists()
+    assert fallback['disease_mat'].shape == exported['disease_mat'].shape
+
+def test_load_model_traces_without_onnx_runtime(tiny_checkpoint, tmp_path, monkeypatch):
+    """With ONNX Runtime disabled the model is TorchScript-traced and nothing is cached"""
+    monkeypatch.setattr('app.USE_ONNX_RUNTIME', False)
+    monkeypatch.setattr('app.ONNX_MODEL_DIR', str(tmp_path))
+
+    model_config = _tiny_model_config(tiny_checkpoint)
+    load_model(model_config)
+    assert isinstance(model_config['model'], torch.jit.ScriptModule)
+    assert list(tmp_path.iterdir()) == []
+    num_views, num_diseases, _ = model_config['disease_mat'].shape
+    assert num_diseases == len(DISEASE_SYMPTOMS)
+    assert torch.allclose(model_config['disease_mat'].norm(dim=-1), torch.ones(num_views, num_diseases))
+
+def test_history_readable_right_after_predict(client):
+    """A prediction's history row is visible to the next history read"""
+    client.post('/patient/register',
+                data=orjson.dumps({'patient_id': 'HIST001', 'name': 'History Patient'}),
+                content_type='application/json')
+    body = orjson.dumps({'symptoms': 'sneezing, runny nose', 'patient_id': 'HIST001'})
+    status_code, _ = wsgi_post('/predict', body)
+    assert status_code == 200
+
+    history = client.get('/patient/HIST001/history').get_json()['history']
+    assert [row['symptoms'] for row in history] == ['sneezing, runny nose']
+
+def test_history_stays_cleared_after_delete(client):
+    """A row saved by /predict never reappears after the history is deleted"""
+    client.post('/patient/register',
+                data=orjson.dumps({'patient_id': 'HIST002', 'name': 'Cleared Patient'}),
+                content_type='application/json')
+    body = orjson.dumps({'symptoms': 'sneezing, runny nose', 'patient_id': 'HIST002'})
+    for _ in range(20):
+        status_code, _ = wsgi_post('/predict', body)
+        assert status_code == 200
+        assert client.delete('/patient/HIST002/history').status_code == 200
+        assert client.get('/patient/HIST002/history').get_json()['history'] == []
+
+def test_db_connections_reused_across_threads():
+    """A connection returned by one request thread is reused by the next"""
+    with get_db() as conn:
+        first = conn
+    borrowed = []
+
+    def borrow():
+        with get_db() as conn:
+            borrowed.append(conn)
+
+    thread = threading.Thread(target=borrow)
+    thread.start()
+    thread.join()
+    assert borrowed == [first]
+
+def test_prediction_stats_ring_averages():
+    """Averages cover only the newest window of values, including after wrap-around"""
+    stats = PredictionStats(response_time_window=4, confidence_window=4)
+    snapshot = stats.snapshot()
+    assert snapshot['avg_response_time'] == 0
+    assert snapshot['avg_confidence'] == 0
+
+    for seconds in (0.1, 0.2, 0.3):
+        stats.record_response_time(seconds)
+    assert stats.snapshot()['avg_response_time'] == pytest.approx(0.2)
+    # Wraps around: 0.1 and 0.2 are overwritten by 0.5 and 0.6
+    for seconds in (0.4, 0.5, 0.6):
+        stats.record_response_time(seconds)
+    assert stats.snapshot()['avg_response_time'] == pytest.approx(0.45)
+
+    for confidence in (0.2, 0.4, 0.6, 0.8, 1.0):
+        stats.record_success('Flu', confidence)
+    stats.record_failure()
+    snapshot = stats.snapshot()
+    assert snapshot['avg_confidence'] == pytest.approx(0.7)
+    assert snapshot['total_predictions'] == 6
+    assert snapshot['successful_predictions'] == 5
+    assert snapshot['failed_predictions'] == 1
+    assert snapshot['disease_counts'] == {'Flu': 5}
+
+def test_performance_reports_ring_averages(client, monkeypatch):
+    """/api/performance reports the counts and ring averages of the shared stats"""
+    stats = PredictionStats(response_time_window=4, confidence_window=4)
+    monkeypatch.setattr(app, 'prediction_stats', stats)
+    assert client.get('/api/performance').status_code == 404
+
+    for seconds in (0.1, 0.2, 0.3, 0.4, 0.5, 0.6):
+        stats.record_response_time(seconds)
+    for confidence in (0.2, 0.4, 0.6, 0.8, 1.0):
+        stats.record_success('Flu', confidence)
+    stats.record_failure()
+
+    data = client.get('/api/performance').get_json()
+    assert data['total_predictions'] == 6
+    assert data['successful_predictions'] == 5
+    assert data['failed_predictions'] == 1
+    assert data['success_rate'] == 83.33
+    assert data['average_response_time_ms'] == 450.0
+    assert data['average_confidence'] == 0.7
+    assert data['top_diseases'] == [{'count': 5, 'disease': 'Flu'}]
+
+# One Prometheus sample line: name, optional {label="value",...}, number
+_SAMPLE_LINE = re.compile(
+    r'([a-zA-Z_:][a-zA-Z0-9_:]*)'
+    r'(?:\{[a-zA-Z_][a-zA-Z0-9_]*="(?:[^"\\\n]|\\.)*"(?:,[a-zA-Z_][a-zA-Z0-9_]*="(?:[^"\\\n]|\\.)*")*\})?'
+    r' -?(?:[0-9]+(?:\.[0-9]*)?(?:e[+-]?[0-9]+)?|NaN|[+-]?Inf)'
+)
+
+def test_metrics_exposition_format(client, monkeypatch):
+    """/metrics declares each metric family once and every sample is well formed"""
+    stats = PredictionStats()
+    for disease in ('Common Cold', 'Flu', 'Common Cold'):
+        stats.record_success(disease, 0.9)
+    monkeypatch.setattr(app, 'prediction_stats', stats)
+
+    response = client.get('/metrics')
     assert response.status_code == 200
-    data = json.loads(response.data)
-    assert 'predictions' in data
\ No newline at end of file
+    lines = [line for line in response.get_data(as_text=True).splitlines() if line]
+
+    type_names = [line.split()[2] for line in lines if line.startswith('# TYPE ')]
+    help_names = [line.split()[2] for line in lines if line.startswith('# HELP ')]
+    assert len(type_names) == len(set(type_names))
+    assert sorted(help_names) == sorted(type_names)
+
+    samples = [line for line in lines if not line.startswith('#')]
+    for line in samples:
+        match = _SAMPLE_LINE.fullmatch(line)
+        assert match, line
+        assert match.group(1) in type_names, line
+    assert 'disease_detector_disease_predictions{disease="common_cold"} 2' in samples
+    assert 'disease_detector_disease_predictions{disease="flu"} 1' in samples